@@ -0,0 +1,49 @@
+from django.db import migrations
+
+# table, index name, key columns, included columns
+INDEXES = [
+    ("tblClaim", "IX_tblClaim_ProcessStamp_Valid", ["ProcessStamp", "ValidityTo"], ["HFID", "ValidityFrom"]),
+    # order of the batch items and services: health facility then claim
+    ("tblClaim", "IX_tblClaim_HFID", ["HFID", "ClaimID"], []),
+    # the deductions and remunerations are read per claim
+    ("tblClaimDedRem", "IX_tblClaimDedRem_ClaimID", ["ClaimID"], []),
+]
+
+
+def _columns(columns):
+    return ", ".join(f"[{column}]" for column in columns)
+
+
+def create_claim_indexes(apps, schema_editor):
+    # the claim tables are owned by the legacy schema, only SQL Server databases carry them.
+    # Not a filtered index: those require QUOTED_IDENTIFIER/ANSI_NULLS ON for every write on tblClaim,
+    # which legacy stored procedures created with other settings would break.
+    if schema_editor.connection.vendor != "microsoft":
+        return
+    for table, index_name, columns, included_columns in INDEXES:
+        include = f" INCLUDE ({_columns(included_columns)})" if included_columns else ""
+        schema_editor.execute(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{index_name}' AND object_id = OBJECT_ID('{table}'))
+                CREATE NONCLUSTERED INDEX [{index_name}] ON [{table}] ({_columns(columns)}){include};
+        """)
+
+
+def drop_claim_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "microsoft":
+        return
+    for table, index_name, _, _ in INDEXES:
+        schema_editor.execute(f"""
+            IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{index_name}' AND object_id = OBJECT_ID('{table}'))
+                DROP INDEX [{index_name}] ON [{table}];
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim_batch', '0005_capitationpayment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_claim_indexes, reverse_code=drop_claim_indexes)
+    ]
@@ -1,13 +1,16 @@
 import calendar
 import datetime
+import functools
 import uuid
 import logging
-import pandas as pd
 import core
 
+from collections import defaultdict
 from datetime import date
-from django.db import connection, transaction
-from django.db.models import Value, F, Sum, Q, Prefetch, Count , Subquery, OuterRef, FloatField
+from django.core.cache import caches
+from django.db import connection, transaction, NotSupportedError
+from django.db.models import Value, F, Sum, Q, Count, Func, Case, When, DateField, DecimalField, \
+    IntegerField
 from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
 from django.utils.translation import gettext as _
 
@@ -22,6 +25,16 @@ from product.models import Product, ProductItemOrService
 
 logger = logging.getLogger(__name__)
 
+# the same calculations recur across payment plans and products of a batch run
+_cached_get_calculation_object = functools.lru_cache(maxsize=64)(get_calculation_object)
+
+BATCH_RUN_CACHE_TIMEOUT = 30
+# periodicity: (the end month must be a multiple of, months back to the start month)
+_PERIODICITY_MAP = {12: (12, 11), 6: (6, 5), 4: (4, 3), 3: (3, 2), 2: (2, 1), 1: (1, 0)}
+# below this number of rows, report sums are computed without pandas
+SMALL_REPORT_SIZE = 500
+BULK_CREATE_BATCH_SIZE = 1000
+
 
 @core.comparable
 class ProcessBatchSubmit(object):
@@ -69,41 +82,22 @@ class ProcessBatchService(object):
                               submit.year, submit.month))
             # stored proc outputs several results,
             # we are only interested in the last one
-            next = True
-            res = None
-            while next:
-                try:
-                    res = cur.fetchone()
-                except Exception:
-                    pass
-                finally:
-                    next = cur.nextset()
+            res = _fetch_last_result_set(cur)[0]
             if res[0] != 0:  # zero means "all done"
                 return str([ProcessBatchSubmitError(res[0])])
         self.capitation_report_data_for_summit(submit)
 
     @classmethod
     def capitation_report_data_for_summit(cls, submit):
-        capitation_payment_products = []
-        for svc_item in [ClaimItem, ClaimService]:
-            capitation_payment_products.extend(
-                svc_item.objects
-                    .filter(claim__status=Claim.STATUS_VALUATED)
-                    .filter(claim__validity_to__isnull=True)
-                    .filter(validity_to__isnull=True)
-                    .filter(status=svc_item.STATUS_PASSED)
-                    .annotate(prod_location=Coalesce("product__location_id", Value(-1)))
-                    .filter(prod_location=submit.location_id if submit.location_id else -1)
-                    .values('product_id')
-                    .distinct()
-            )
+        capitation_payment_products = _capitation_payment_products_queryset(ClaimItem, submit.location_id)\
+            .union(_capitation_payment_products_queryset(ClaimService, submit.location_id))
 
         region_id, district_id = _get_capitation_region_and_district(submit.location_id)
-        for product in set(map(lambda x: x['product_id'], capitation_payment_products)):
+        for product_id in capitation_payment_products:
             params = {
                 'region_id': region_id,
                 'district_id': district_id,
-                'prod_id': product,
+                'prod_id': product_id,
                 'year': submit.year,
                 'month': submit.month,
             }
@@ -115,13 +109,31 @@ class ProcessBatchService(object):
 
     @classmethod
     def batch_run_already_executed(cls, year, month, location_id):
-        return BatchRun.objects \
-            .filter(run_year=year) \
-            .filter(run_month=month) \
-            .annotate(nn_location_id=Coalesce("location_id", Value(-1))) \
-            .filter(nn_location_id=-1 if location_id is None else location_id) \
-            .filter(validity_to__isnull=True)\
-            .exists()
+        # the UI polls this check, a run that exists is remembered for a while to spare the DB round-trip.
+        # A missing run is never cached: it may be created at any time, possibly by another process.
+        # Runs are not voided from this module, one voided elsewhere is still reported until the key expires.
+        cache = caches['default']
+        key = _batch_run_cache_key(year, month, location_id)
+        if cache.get(key):
+            return True
+        exists = _batch_run_exists(year, month, location_id)
+        if exists:
+            cache.set(key, True, BATCH_RUN_CACHE_TIMEOUT)
+        return exists
+
+
+def _batch_run_cache_key(year, month, location_id):
+    return f"batchrun:{year}:{month}:{-1 if location_id is None else location_id}"
+
+
+def _batch_run_exists(year, month, location_id):
+    return BatchRun.objects \
+        .filter(run_year=year) \
+        .filter(run_month=month) \
+        .annotate(nn_location_id=Coalesce("location_id", Value(-1))) \
+        .filter(nn_location_id=-1 if location_id is None else location_id) \
+        .filter(validity_to__isnull=True) \
+        .exists()
 
 
 @transaction.atomic
@@ -130,15 +142,8 @@ def process_batch(audit_user_id, location_id, period, year):
     if location_id == -1:
         location_id = None
 
-    # Transactional stuff
-    already_run_batch = BatchRun.objects \
-        .filter(run_year=year) \
-        .filter(run_month=period) \
-        .annotate(nn_location_id=Coalesce("location_id", Value(-1))) \
-        .filter(nn_location_id=-1 if location_id is None else location_id) \
-        .filter(validity_to__isnull=True).values("id").first()
-
-    if already_run_batch:
+    # Transactional stuff, never answered from the cache
+    if _batch_run_exists(year, period, location_id):
         return [str(ProcessBatchSubmitError(2))]
     _, days_in_month = calendar.monthrange(year, period)
     end_date = datetime.datetime(year, period, days_in_month)
@@ -159,22 +164,54 @@ def process_batch(audit_user_id, location_id, period, year):
         return [str(ProcessBatchSubmitError(-1, str(exc)))]
 
 
+def _capitation_payment_products_queryset(svc_item, location_id):
+    return svc_item.objects \
+        .filter(claim__status=Claim.STATUS_VALUATED) \
+        .filter(claim__validity_to__isnull=True) \
+        .filter(validity_to__isnull=True) \
+        .filter(status=svc_item.STATUS_PASSED) \
+        .annotate(prod_location=Coalesce("product__location_id", Value(-1))) \
+        .filter(prod_location=location_id if location_id else -1) \
+        .values_list('product_id', flat=True) \
+        .order_by()
+
+
+@functools.lru_cache(maxsize=1024)
 def _get_capitation_region_and_district(location_id):
     if not location_id:
         return None, None
-    location = Location.objects.get(id=location_id)
+    location = Location.objects.only('id', 'type', 'parent_id').get(id=location_id)
     region_id = None
     district_id = None
 
     if location.type == 'D':
         district_id = location_id
-        region_id = location.parent.id
+        region_id = location.parent_id
     elif location.type == 'R':
         region_id = location.id
 
     return region_id, district_id
 
 
+class BatchInserter(object):
+    """
+    Buffer handed to the calculation rules through work_data["batch_inserter"] so that
+    the rows they generate per claim are inserted with bulk_create instead of one by one.
+    """
+
+    def __init__(self, batch_size=BULK_CREATE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.buffer = defaultdict(list)
+
+    def add(self, obj):
+        self.buffer[type(obj)].append(obj)
+
+    def flush(self):
+        for model, objs in self.buffer.items():
+            model.objects.bulk_create(objs, batch_size=self.batch_size)
+        self.buffer.clear()
+
+
 def do_process_batch(audit_user_id, location_id, end_date):
     processed_ids = set()  # As we update claims, we add the claims not in relative pricing and then update the status
     period = end_date.month
@@ -196,46 +233,57 @@ def do_process_batch(audit_user_id, location_id, end_date):
     # period_quarter = period - 2 if period % 3 == 0 else 0
     # period_sem = period - 5 if period % 6 == 0 else 0
 
-    products = get_product_queryset(end_date, location_id)
-    # 1 per product (Ideally per pool but the notion doesn't exist yet)
-    if products:
-        for product in products:
-            logger.debug("do_process_batch creating work_data for batch run process")
-            work_data = {"created_run": created_run, "product": product, "end_date": end_date}
-            logger.debug("do_process_batch created work_data for batch run process")
-            allocated_contribution = {}
-            # 1.2 get all the payment plan per product
-            work_data["payment_plans"] = get_payment_plan_queryset(product, end_date)
-            # valuate the claims
-            # 5 Generate BatchPayment per product (Ideally per pool but the notion doesn't exist yet)
-            trigger_calculation_based_on_context(
-                "BatchValuate", work_data, end_date, product, location_id, allocated_contribution, audit_user_id
-            )
-            # 5.1 filter a calculation valid for batchRun with context BatchPayment (got via 0.2)
-            # 54.2 Execute the converter per product/batch run/claim (not claims)
-            trigger_calculation_based_on_context(
-                "BatchPayment", work_data, end_date, product, location_id, allocated_contribution, audit_user_id
-            )
-            # save the batch run into db
-            logger.debug("do_process_batch created run: %s", created_run.id)
-    else:
-        logger.info("no product found in  %s for %s/%s", location_id, period, year)
+    try:
+        products = list(get_product_queryset(end_date, location_id))
+        # 1 per product (Ideally per pool but the notion doesn't exist yet)
+        if products:
+            for product in products:
+                do_process_batch_for_product(created_run, product, end_date, location_id, audit_user_id)
+        else:
+            logger.info("no product found in  %s for %s/%s", location_id, period, year)
+    finally:
+        # calculation objects must not outlive the batch run in long-lived workers
+        _cached_get_calculation_object.cache_clear()
     return created_run
 
 
+def do_process_batch_for_product(created_run, product, end_date, location_id, audit_user_id):
+    # products are independent from each other within a batch run
+    logger.debug("do_process_batch creating work_data for batch run process")
+    work_data = {"created_run": created_run, "product": product, "end_date": end_date,
+                 "batch_inserter": BatchInserter()}
+    logger.debug("do_process_batch created work_data for batch run process")
+    allocated_contribution = {}
+    # 1.2 get all the payment plan per product
+    work_data["payment_plans"] = list(get_payment_plan_queryset(product, end_date))
+    # valuate the claims
+    # 5 Generate BatchPayment per product (Ideally per pool but the notion doesn't exist yet)
+    trigger_calculation_based_on_context(
+        "BatchValuate", work_data, end_date, product, location_id, allocated_contribution, audit_user_id
+    )
+    # 5.1 filter a calculation valid for batchRun with context BatchPayment (got via 0.2)
+    # 54.2 Execute the converter per product/batch run/claim (not claims)
+    trigger_calculation_based_on_context(
+        "BatchPayment", work_data, end_date, product, location_id, allocated_contribution, audit_user_id
+    )
+    # save the batch run into db
+    logger.debug("do_process_batch created run: %s", created_run.id)
+
+
 def trigger_calculation_based_on_context(
     context, work_data, end_date, product,
     location_id, allocated_contribution, user_id
 ):
-    if work_data["payment_plans"]:
-        for payment_plan in work_data["payment_plans"]:
+    payment_plans = list(work_data["payment_plans"])
+    if payment_plans:
+        for payment_plan in payment_plans:
             start_date = get_start_date(end_date, payment_plan.periodicity)
             # run only when it makes sense based on periodicitiy
             if start_date is not None:
                 allocated_contribution, work_data = update_work_data(
                     work_data, product, start_date, end_date, allocated_contribution
                 )
-                calculation = get_calculation_object(payment_plan.calculation)
+                calculation = _cached_get_calculation_object(payment_plan.calculation)
                 if calculation is not None:
                     rcr = calculation.calculate_if_active_for_object(
                         payment_plan, context=context,
@@ -244,6 +292,9 @@ def trigger_calculation_based_on_context(
                     )
                     if rcr:
                         logger.debug("conversion processed for: %s", rcr[0][0])
+                # write what the calculation rule buffered for this payment plan
+                if "batch_inserter" in work_data:
+                    work_data["batch_inserter"].flush()
 
 
 def update_work_data(work_data, product, start_date, end_date, allocated_contribution=None):
@@ -255,10 +306,10 @@ def update_work_data(work_data, product, start_date, end_date, allocated_contrib
     work_data['claims'] = get_claim_queryset(product, start_date, end_date)
     if allocated_contribution is None:
         allocated_contribution = {}
-    start_date_str = str(start_date)
-    if start_date_str not in allocated_contribution:
-        allocated_contribution[start_date_str] = get_allocated_premium(work_data["contributions"], start_date, end_date)
-    work_data['allocated_contributions'] = allocated_contribution[start_date_str]
+    # allocated_contribution is scoped to the product, as are the contributions
+    if start_date not in allocated_contribution:
+        allocated_contribution[start_date] = get_allocated_premium(work_data["contributions"], start_date, end_date)
+    work_data['allocated_contributions'] = allocated_contribution[start_date]
     return allocated_contribution, work_data
 
 
@@ -270,24 +321,30 @@ def get_payment_plan_queryset(product, end_date):
         .filter(is_deleted=False)
 
 
+def get_processed_claim_ids(start_date, end_date):
+    # covered by the index on tblClaim(ProcessStamp, ValidityTo)
+    return Claim.objects\
+        .filter(process_stamp__range=(start_date, end_date))\
+        .filter(validity_to__isnull=True)\
+        .values('id')
+
+
 def get_items_queryset(product, start_date, end_date):
     return ClaimItem.objects\
         .filter(validity_to__isnull=True)\
-        .filter(claim__process_stamp__lte=end_date)\
-        .filter(claim__process_stamp__gte=start_date)\
+        .filter(claim_id__in=get_processed_claim_ids(start_date, end_date))\
         .filter(product=product)\
         .select_related('claim__health_facility')\
-        .order_by('claim__health_facility').order_by('claim')
+        .order_by('claim__health_facility_id', 'claim_id')
 
 
 def get_services_queryset(product, start_date, end_date):
     return ClaimService.objects\
-        .filter(claim__process_stamp__lte=end_date)\
-        .filter(claim__process_stamp__gte=start_date)\
+        .filter(claim_id__in=get_processed_claim_ids(start_date, end_date))\
         .filter(validity_to__isnull=True)\
         .filter(product=product)\
         .select_related('claim__health_facility')\
-        .order_by('claim__health_facility').order_by('claim')
+        .order_by('claim__health_facility_id', 'claim_id')
 
 
 def get_claim_queryset(product, start_date, end_date):
@@ -296,8 +353,9 @@ def get_claim_queryset(product, start_date, end_date):
         .filter(validity_from__gte=start_date)\
         .filter(validity_to__isnull=True)\
         .filter(process_stamp__lte=end_date)\
-        .filter((Q(items__product=product) | Q(services__product=product)))\
-        .distinct()
+        .filter(Q(id__in=ClaimItem.objects.filter(product=product).values('claim_id'))
+                | Q(id__in=ClaimService.objects.filter(product=product).values('claim_id')))\
+        .select_related('health_facility', 'insuree')
 
 
 def get_contribution_queryset(product, start_date, end_date):
@@ -313,28 +371,59 @@ def get_product_queryset(end_date, location_id):
     queryset = Product.objects\
         .filter(validity_to__isnull=True)\
         .filter(date_from__lte=end_date)\
-        .filter(Q(date_to__gte=end_date) | Q(date_to__isnull=True))
+        .filter(Q(date_to__gte=end_date) | Q(date_to__isnull=True))\
+        .select_related('location')
     if location_id is not None:
         return queryset.filter(location_id=location_id)
     else:
         return queryset.filter(location_id__isnull=True)
 
 
+class DaysBetween(Func):
+    # number of days from start to stop, both included
+    arity = 2
+    output_field = IntegerField()
+
+    def _as_days_sql(self, compiler, template, reverse=True):
+        start, stop = self.get_source_expressions()
+        first, second = (stop, start) if reverse else (start, stop)
+        first_sql, first_params = compiler.compile(first)
+        second_sql, second_params = compiler.compile(second)
+        return template % (first_sql, second_sql), (*first_params, *second_params)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # date arithmetic differs per database (on MySQL, date - date is not a number of days)
+        raise NotSupportedError(f"DaysBetween is not implemented for {connection.vendor}")
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self._as_days_sql(compiler, "(CAST(%s AS date) - CAST(%s AS date) + 1)")
+
+    def as_microsoft(self, compiler, connection, **extra_context):
+        return self._as_days_sql(compiler, "(DATEDIFF(day, %s, %s) + 1)", reverse=False)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self._as_days_sql(compiler, "(CAST(julianday(%s) - julianday(%s) AS INTEGER) + 1)")
+
+
 def get_allocated_premium(premiums, start_date, end_date):
     # Calculate allcated contributions
-    # go trough the contribution and find the allocated contribution
-    allocated_premiums = 0
-    for premium in premiums:
-        allocation_start = max(premium.policy.effective_date, start_date)
-        if isinstance(allocation_start, datetime.datetime):
-            allocation_start = allocation_start.date()
-        allocation_stop = min(end_date, premium.policy.expiry_date)
-        if isinstance(allocation_stop, datetime.datetime):
-            allocation_stop = allocation_stop.date()
-        allocation_diff = (allocation_stop - allocation_start).days + 1
-        policy_duration = (premium.policy.expiry_date - premium.policy.effective_date).days + 1
-        allocated_premiums += premium.amount * allocation_diff / policy_duration
-    return allocated_premiums
+    # the share of each contribution falling into [start_date, end_date] is computed by the database
+    if isinstance(start_date, datetime.datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, datetime.datetime):
+        end_date = end_date.date()
+    allocation_start = Case(
+        When(policy__effective_date__gt=start_date, then=F('policy__effective_date')),
+        default=Value(start_date), output_field=DateField())
+    allocation_stop = Case(
+        When(policy__expiry_date__lt=end_date, then=F('policy__expiry_date')),
+        default=Value(end_date), output_field=DateField())
+    allocated_premiums = premiums.aggregate(total=Sum(
+        F('amount') * DaysBetween(allocation_start, allocation_stop)
+        / DaysBetween(F('policy__effective_date'), F('policy__expiry_date')),
+        output_field=DecimalField(max_digits=18, decimal_places=2)
+    ))['total']
+    return allocated_premiums or 0
 
 
 def get_hospital_claim_filter(ceiling_interpretation, mode='I', prefix=''):
@@ -373,50 +462,62 @@ def get_period(start_date, end_date):
 
 
 def get_start_date(end_date, periodicity):
-    # create the possible start dates
-    year = end_date.year
+    # the periodicity is the number of months of the period, which starts (periodicity - 1) months before
+    # the end_date month: 12 yearly, 6 semester, 4 four-monthly, 3 quarter, 2 bimonthly, 1 monthly
+    entry = _PERIODICITY_MAP.get(periodicity)
+    if entry is None:
+        return None
+    divisor, offset = entry
     month = end_date.month
-    if periodicity == 12:
-        # yearly
-        return datetime.date(year, 1, 1) if month == 12 else None
-    elif periodicity == 6:
-        # semester
-        return datetime.date(year, month - 5, 1) if month % 6 == 0 else None
-    elif periodicity == 4:
-        # quarter
-        return datetime.date(year, month - 4, 1) if month % 4 == 0 else None
-    elif periodicity == 3:
-        # quarter
-        return datetime.date(year, month - 2, 1) if month % 3 == 0 else None
-    elif periodicity == 2:
-        # quarter
-        return datetime.date(year, month - 1, 1) if month % 2 == 0 else None
-    elif periodicity == 1:
-        # monthy
-        return datetime.date(year, month, 1)
-    else:
+    if month % divisor:
         return None
+    return datetime.date(end_date.year, month - offset, 1)
 
 
 def update_claim_valuated(claims, batch_run, claim_based_value_subquery=0):
     # 4 update the claim Total amounts if all Item and services got "valuated"
-    service_subquery = Subquery(
-        ClaimItem.objects.filter(claim=OuterRef('pk')).filter(legacy_id__isnull=True).values('claim_id').annotate(
-            item_sum=Sum('price_valuated')).values('item_sum').order_by()[:1],
-        output_field=FloatField()
-    )
-    item_subquery = Subquery(
-        ClaimService.objects.filter(claim=OuterRef('pk')).filter(legacy_id__isnull=True).values('claim_id').annotate(
-            service_sum=Sum('price_valuated')).values('service_sum').order_by()[:1],
-        output_field=FloatField()
-    )
+    # the item and service totals are grouped once instead of being correlated per claim
+    item_sums = _valuated_sums_by_claim(ClaimItem, claims)
+    service_sums = _valuated_sums_by_claim(ClaimService, claims)
+    remunerated_claims = [
+        Claim(id=claim_id,
+              remunerated=item_sums.get(claim_id, 0) + service_sums.get(claim_id, 0) + claim_based_value)
+        for claim_id, claim_based_value in claims
+        .prefetch_related(None)
+        .annotate(claim_based_value=Coalesce(
+            claim_based_value_subquery, 0, output_field=DecimalField(max_digits=18, decimal_places=2)))
+        .values_list('id', 'claim_based_value')
+    ]
+    Claim.objects.bulk_update(remunerated_claims, ['remunerated'], batch_size=1000)
     claims.update(
         status=Claim.STATUS_VALUATED,
         batch_run=batch_run,
-        remunerated=Coalesce(service_subquery, 0) + Coalesce(item_subquery, 0) + Coalesce(claim_based_value_subquery, 0)
     )
 
 
+def _valuated_sums_by_claim(model, claims):
+    return dict(
+        model.objects
+        .filter(claim__in=claims)
+        .filter(legacy_id__isnull=True)
+        .values('claim_id')
+        .annotate(valuated_sum=Coalesce(
+            Sum('price_valuated'), 0, output_field=DecimalField(max_digits=18, decimal_places=2)))
+        .order_by()
+        .values_list('claim_id', 'valuated_sum')
+    )
+
+
+def _fetch_last_result_set(cursor):
+    # only row-returning result sets are fetched, the others (row counts...) are skipped
+    data = None
+    while True:
+        if cursor.description is not None:
+            data = cursor.fetchall()
+        if not cursor.nextset():
+            return data
+
+
 def process_batch_report_data_with_claims(prms):
     with connection.cursor() as cur:
         sql = """\
@@ -440,41 +541,36 @@ def process_batch_report_data_with_claims(prms):
         ))
         # stored proc outputs several results,
         # we are only interested in the last one
-        next = True
-        data = None
-        while next:
-            try:
-                data = cur.fetchall()
-            except Exception:
-                pass
-            finally:
-                next = cur.nextset()
+        data = _fetch_last_result_set(cur)
     return [{
-        "ClaimCode": row[0],
-        "DateClaimed": row[1].strftime("%Y-%m-%d") if row[1] is not None else None,
-        "OtherNamesAdmin": row[2],
-        "LastNameAdmin": row[3],
-        "DateFrom": row[4].strftime("%Y-%m-%d") if row[4] is not None else None,
-        "DateTo": row[5].strftime("%Y-%m-%d") if row[5] is not None else None,
-        "CHFID": row[6],
-        "OtherNames": row[7],
-        "LastName": row[8],
-        "HFID": row[9],
-        "HFCode": row[10],
-        "HFName": row[11],
-        "AccCode": row[12],
-        "ProdID": row[13],
-        "ProductCode": row[14],
-        "ProductName": row[15],
-        "PriceAsked": row[16],
-        "PriceApproved": row[17],
-        "PriceAdjusted": row[18],
-        "RemuneratedAmount": row[19],
-        "DistrictID": row[20],
-        "DistrictName": row[21],
-        "RegionID": row[22],
-        "RegionName": row[23]
-    } for row in data]
+        "ClaimCode": claim_code,
+        "DateClaimed": date_claimed.strftime("%Y-%m-%d") if date_claimed is not None else None,
+        "OtherNamesAdmin": other_names_admin,
+        "LastNameAdmin": last_name_admin,
+        "DateFrom": date_from.strftime("%Y-%m-%d") if date_from is not None else None,
+        "DateTo": date_to.strftime("%Y-%m-%d") if date_to is not None else None,
+        "CHFID": chf_id,
+        "OtherNames": other_names,
+        "LastName": last_name,
+        "HFID": hf_id,
+        "HFCode": hf_code,
+        "HFName": hf_name,
+        "AccCode": acc_code,
+        "ProdID": prod_id,
+        "ProductCode": product_code,
+        "ProductName": product_name,
+        "PriceAsked": price_asked,
+        "PriceApproved": price_approved,
+        "PriceAdjusted": price_adjusted,
+        "RemuneratedAmount": remunerated_amount,
+        "DistrictID": district_id,
+        "DistrictName": district_name,
+        "RegionID": region_id,
+        "RegionName": region_name
+    } for (claim_code, date_claimed, other_names_admin, last_name_admin, date_from, date_to, chf_id,
+           other_names, last_name, hf_id, hf_code, hf_name, acc_code, prod_id, product_code, product_name,
+           price_asked, price_approved, price_adjusted, remunerated_amount, district_id, district_name,
+           region_id, region_name) in data]
 
 
 def process_batch_report_data(prms):
@@ -500,26 +596,19 @@ def process_batch_report_data(prms):
         ))
         # stored proc outputs several results,
         # we are only interested in the last one
-        next = True
-        data = None
-        while next:
-            try:
-                data = cur.fetchall()
-            except Exception:
-                pass
-            finally:
-                next = cur.nextset()
+        data = _fetch_last_result_set(cur)
     return [{
-        "RegionName": row[0],
-        "DistrictName": row[1],
-        "HFCode": row[2],
-        "HFName": row[3],
-        "ProductCode": row[4],
-        "ProductName": row[5],
-        "RemuneratedAmount": row[6],
-        "AccCodeRemuneration": row[7],
-        "AccCode": row[8]
-    } for row in data]
+        "RegionName": region_name,
+        "DistrictName": district_name,
+        "HFCode": hf_code,
+        "HFName": hf_name,
+        "ProductCode": product_code,
+        "ProductName": product_name,
+        "RemuneratedAmount": remunerated_amount,
+        "AccCodeRemuneration": acc_code_remuneration,
+        "AccCode": acc_code
+    } for (region_name, district_name, hf_code, hf_name, product_code, product_name, remunerated_amount,
+           acc_code_remuneration, acc_code) in data]
 
 
 def process_capitation_payment_data(params):
@@ -537,35 +626,35 @@ def get_commision_payment_report_data(params):
 
         # stored proc outputs several results,
         # we are only interested in the last one
-        next = True
-        data = None
-        while next:
-            try:
-                data = cur.fetchall()
-            except Exception as e:
-                pass
-            finally:
-                next = cur.nextset()
+        data = _fetch_last_result_set(cur)
     return data
 
 
-def _execute_capitation_payment_procedure(cursor, procedure, params):
-    sql = F"""\
+def _build_capitation_payment_sql(procedure):
+    return F"""\
                 DECLARE @HF AS xAttributeV;
 
-                INSERT INTO @HF (Code, Name) VALUES ('D', 'Dispensary');
-                INSERT INTO @HF (Code, Name) VALUES ('C', 'Health Centre');
-                INSERT INTO @HF (Code, Name) VALUES ('H', 'Hospital');
+                INSERT INTO @HF (Code, Name) VALUES ('D', 'Dispensary'), ('C', 'Health Centre'), ('H', 'Hospital');
 
                 EXEC [dbo].[{procedure}]
                     @RegionId = %s,
                     @DistrictId = %s,
                     @ProdId = %s,
                     @Year = %s,
-                    @Month = %s,	
+                    @Month = %s,
                     @HFLevel = @HF;
             """
 
+
+# only the procedure name varies, the statements are built once
+_CAPITATION_PAYMENT_SQL = {
+    procedure: _build_capitation_payment_sql(procedure)
+    for procedure in ('uspCreateCapitationPaymentReportData', 'uspSSRSRetrieveCapitationPaymentReportData')
+}
+
+
+def _execute_capitation_payment_procedure(cursor, procedure, params):
+    sql = _CAPITATION_PAYMENT_SQL.get(procedure) or _build_capitation_payment_sql(procedure)
     cursor.execute(sql, (
         params.get('region_id', None),
         params.get('district_id', None),
@@ -575,100 +664,68 @@ def _execute_capitation_payment_procedure(cursor, procedure, params):
     ))
 
 
-def regions_sum(df, show_claims):
-    if show_claims:
-        return df.groupby(['RegionName'])[
-            'PriceAsked', 'PriceApproved', 'PriceAdjusted', 'RemuneratedAmount'].sum().to_dict()
-    else:
-        return df.groupby(['RegionName'])['RemuneratedAmount'].sum().to_dict()
-
-
-def districts_sum(df, show_claims):
-    if show_claims:
-        return df.groupby(['RegionName', 'DistrictName'])[
-            'PriceAsked', 'PriceApproved', 'PriceAdjusted', 'RemuneratedAmount'].sum().to_dict()
-    else:
-        return df.groupby(['RegionName', 'DistrictName'])['RemuneratedAmount'].sum().to_dict()
-
-
-def health_facilities_sum(df, show_claims):
-    if show_claims:
-        return df.groupby(['RegionName', 'DistrictName', 'HFCode'])[
-            'PriceAsked', 'PriceApproved', 'PriceAdjusted', 'RemuneratedAmount'].sum().to_dict()
-    else:
-        return df.groupby(['RegionName', 'DistrictName', 'HFCode'])['RemuneratedAmount'].sum().to_dict()
-
-
-def products_sum(df, show_claims):
-    if show_claims:
-        return df.groupby(['RegionName', 'DistrictName', 'ProductCode'])[
-            'PriceAsked', 'PriceApproved', 'PriceAdjusted', 'RemuneratedAmount'].sum().to_dict()
-    else:
-        return df.groupby(['RegionName', 'DistrictName', 'ProductCode'])['RemuneratedAmount'].sum().to_dict()
+def report_data_frame(data):
+    # pandas is heavy to import and only needed for the large reports
+    import pandas as pd
+    # object columns keep the stored procedure values, an int column holding a NULL would turn to float
+    return pd.DataFrame.from_dict(data, dtype=object)
 
 
-def region_and_district_sums(row, regions_sum, districts_sum, show_claims):
+def report_metrics(show_claims):
     if show_claims:
-        return {
-            'SUMR_PriceAsked': regions_sum['PriceAsked'][row['RegionName']],
-            'SUMR_PriceApproved': regions_sum['PriceApproved'][row['RegionName']],
-            'SUMR_PriceAdjusted': regions_sum['PriceAdjusted'][row['RegionName']],
-            'SUMR_RemuneratedAmount': regions_sum['RemuneratedAmount'][row['RegionName']],
-            'SUMD_PriceAsked': districts_sum['PriceAsked'][(row['RegionName'], row['DistrictName'])],
-            'SUMD_PriceApproved': districts_sum['PriceApproved'][(row['RegionName'], row['DistrictName'])],
-            'SUMD_PriceAdjusted': districts_sum['PriceAdjusted'][(row['RegionName'], row['DistrictName'])],
-            'SUMD_RemuneratedAmount': districts_sum['RemuneratedAmount'][(row['RegionName'], row['DistrictName'])]
-        }
+        return ['PriceAsked', 'PriceApproved', 'PriceAdjusted', 'RemuneratedAmount']
     else:
-        return {
-            'SUMR_RemuneratedAmount': regions_sum[row['RegionName']],
-            'SUMD_RemuneratedAmount': districts_sum[(row['RegionName'], row['DistrictName'])]
-        }
-
-
-def add_sums_by_hf(data, regions_sum, districts_sum, health_facilities_sum, show_claims):
-    if show_claims:
-        data = [{**row,
-                 **region_and_district_sums(row, regions_sum, districts_sum, show_claims),
-                 'SUMHF_PriceAsked': health_facilities_sum['PriceAsked'][
-                     (row['RegionName'], row['DistrictName'], row['HFCode'])],
-                 'SUMHF_PriceApproved': health_facilities_sum['PriceApproved'][
-                     (row['RegionName'], row['DistrictName'], row['HFCode'])],
-                 'SUMHF_PriceAdjusted': health_facilities_sum['PriceAdjusted'][
-                     (row['RegionName'], row['DistrictName'], row['HFCode'])],
-                 'SUMHF_RemuneratedAmount': health_facilities_sum['RemuneratedAmount'][
-                     (row['RegionName'], row['DistrictName'], row['HFCode'])]
-                 } for row in data]
-    else:
-        data = [{**row,
-                 **region_and_district_sums(row, regions_sum, districts_sum, show_claims),
-                 'SUMHF_RemuneratedAmount': health_facilities_sum[
-                     (row['RegionName'], row['DistrictName'], row['HFCode'])]
-                 } for row in data]
-    return sorted(data, key=lambda i: (
-        i['RegionName'], i['DistrictName'], i['HFCode']))
-
-
-def add_sums_by_prod(data, regions_sum, districts_sum, products_sum, show_claims):
-    if show_claims:
-        data = [{**row,
-                 **region_and_district_sums(row, regions_sum, districts_sum, show_claims),
-                 'SUMP_PriceAsked': products_sum['PriceAsked'][
-                     (row['RegionName'], row['DistrictName'], row['ProductCode'])],
-                 'SUMP_PriceApproved': products_sum['PriceApproved'][
-                     (row['RegionName'], row['DistrictName'], row['ProductCode'])],
-                 'SUMP_PriceAdjusted': products_sum['PriceAdjusted'][
-                     (row['RegionName'], row['DistrictName'], row['ProductCode'])],
-                 'SUMP_RemuneratedAmount': products_sum['RemuneratedAmount'][
-                     (row['RegionName'], row['DistrictName'], row['ProductCode'])]
-                 } for row in data]
-    else:
-        data = [{**row,
-                 **region_and_district_sums(row, regions_sum, districts_sum, show_claims),
-                 'SUMP_RemuneratedAmount': products_sum[(row['RegionName'], row['DistrictName'], row['ProductCode'])]
-                 } for row in data]
-    return sorted(data, key=lambda i: (
-        i['RegionName'], i['DistrictName'], i['ProductCode']))
+        return ['RemuneratedAmount']
+
+
+def hierarchical_sums(df, leaf_column, show_claims):
+    # single groupby at the finest level, districts and regions are rolled up from it
+    leaves = df.groupby(['RegionName', 'DistrictName', leaf_column])[report_metrics(show_claims)].sum()
+    districts = leaves.groupby(level=[0, 1]).sum()
+    regions = districts.groupby(level=0).sum()
+    return regions, districts, leaves
+
+
+def add_sums(df, leaf_column, leaf_prefix, show_claims):
+    regions, districts, leaves = hierarchical_sums(df, leaf_column, show_claims)
+    keys = ['RegionName', 'DistrictName', leaf_column]
+    out = df.join(regions.add_prefix('SUMR_'), on=keys[:1]) \
+        .join(districts.add_prefix('SUMD_'), on=keys[:2]) \
+        .join(leaves.add_prefix(leaf_prefix), on=keys) \
+        .sort_values(keys, kind='mergesort')
+    # keep the None of the stored procedure output instead of pandas' NaN
+    return out.astype(object).where(out.notna(), None).to_dict(orient='records')
+
+
+def add_sums_by_hf(df, show_claims):
+    return add_sums(df, 'HFCode', 'SUMHF_', show_claims)
+
+
+def add_sums_by_prod(df, show_claims):
+    return add_sums(df, 'ProductCode', 'SUMP_', show_claims)
+
+
+def _small_report_aggregate(data, leaf_column, leaf_prefix, show_claims):
+    # same output as add_sums, computed in one pass without building a DataFrame
+    metrics = report_metrics(show_claims)
+    keys = ('RegionName', 'DistrictName', leaf_column)
+    levels = ((1, 'SUMR_'), (2, 'SUMD_'), (3, leaf_prefix))
+    sums = defaultdict(lambda: defaultdict(int))
+    for row in data:
+        for depth, _ in levels:
+            group_sums = sums[tuple(row[key] for key in keys[:depth])]
+            for metric in metrics:
+                if row[metric] is not None:
+                    group_sums[metric] += row[metric]
+    result = []
+    for row in sorted(data, key=lambda r: tuple(r[key] for key in keys)):
+        row = dict(row)
+        for depth, prefix in levels:
+            group_sums = sums[tuple(row[key] for key in keys[:depth])]
+            for metric in metrics:
+                row[prefix + metric] = group_sums[metric]
+        result.append(row)
+    return result
 
 
 class ReportDataService(object):
@@ -685,16 +742,13 @@ class ReportDataService(object):
             data = process_batch_report_data(prms)
         if not data:
             raise ValueError(_("claim_batch.reports.nodata"))
-        df = pd.DataFrame.from_dict(data)
+        if len(data) < SMALL_REPORT_SIZE:
+            if group == "H":
+                return _small_report_aggregate(data, 'HFCode', 'SUMHF_', show_claims)
+            else:
+                return _small_report_aggregate(data, 'ProductCode', 'SUMP_', show_claims)
+        df = report_data_frame(data)
         if group == "H":
-            return add_sums_by_hf(data,
-                                  regions_sum(df, show_claims),
-                                  districts_sum(df, show_claims),
-                                  health_facilities_sum(df, show_claims),
-                                  show_claims)
+            return add_sums_by_hf(df, show_claims)
         else:
-            return add_sums_by_prod(data,
-                                    regions_sum(df, show_claims),
-                                    districts_sum(df, show_claims),
-                                    products_sum(df, show_claims),
-                                    show_claims)
+            return add_sums_by_prod(df, show_claims)
@@ -1,5 +1,5 @@
-import calendar
 import datetime
+from decimal import Decimal
 
 from claim.gql_mutations import validate_and_process_dedrem_claim
 from claim.models import ClaimDedRem, Claim
@@ -7,14 +7,29 @@ from claim.test_helpers import (
     create_test_claim,
     create_test_claimservice,
     create_test_claimitem,
-    delete_claim_with_itemsvc_dedrem_and_history,
 )
-from claim_batch.services import do_process_batch
+from claim_batch.models import BatchRun, RelativeDistribution
+from claim_batch.services import (
+    BatchInserter,
+    ProcessBatchService,
+    do_process_batch,
+    get_start_date,
+    update_claim_valuated,
+    add_sums_by_hf,
+    add_sums_by_prod,
+    report_data_frame,
+    _small_report_aggregate,
+    _batch_run_cache_key,
+    get_allocated_premium,
+    get_contribution_queryset,
+)
 from contribution.test_helpers import create_test_payer, create_test_premium
-from contribution_plan.models import PaymentPlan
 from contribution_plan.tests.helpers import create_test_payment_plan
 from core.services import create_or_update_interactive_user, create_or_update_core_user
-from django.test import TestCase
+from core.utils import TimeUtils
+from django.core.cache import caches
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase
 from insuree.test_helpers import create_test_insuree
 from medical.test_helpers import create_test_service, create_test_item
 from medical_pricelist.test_helpers import (
@@ -41,16 +56,51 @@ _TEST_DATA_USER = {
     "language": "en",
     "roles": [1, 5, 9],
 }
+# fixed claim validity, so that the batch period does not depend on the current month
+_VALIDITY_FROM = datetime.datetime(2023, 6, 15)
+_PROCESS_STAMP = datetime.datetime(2023, 6, 29)
+_END_DATE = datetime.datetime(2023, 6, 30)
+_PAYMENT_PLAN_JSON_EXT = {
+    'calculation_rule': {
+        'hf_level_1': 'H',
+        'hf_sublevel_1': "null",
+        'hf_level_2': 'D',
+        'hf_sublevel_2': "null",
+        'hf_level_3': 'C',
+        'hf_sublevel_3': "null",
+        'hf_level_4': "null",
+        'hf_sublevel_4': "null",
+        'distr_1': 100,
+        'distr_2': 100,
+        'distr_3': 100,
+        'distr_4': 100,
+        'distr_5': 100,
+        'distr_6': 100,
+        'distr_7': 100,
+        'distr_8': 100,
+        'distr_9': 100,
+        'distr_10': 100,
+        'distr_11': 100,
+        'distr_12': 100,
+        'claim_type': 'B'
+    }
+}
+_PAYMENT_PLAN_PROPS = {
+    'periodicity': 1,
+    'date_valid_from': '2019-01-01',
+    'date_valid_to': '2050-01-01',
+    'json_ext': _PAYMENT_PLAN_JSON_EXT,
+}
 
 
 class BatchRunTest(TestCase):
-    def setUp(self) -> None:
-        super(BatchRunTest, self).setUp()
+    @classmethod
+    def setUpTestData(cls):
         i_user, i_user_created = create_or_update_interactive_user(
             user_id=None, data=_TEST_DATA_USER, audit_user_id=999, connected=False)
         user, user_created = create_or_update_core_user(
             user_uuid=None, username=_TEST_DATA_USER["username"], i_user=i_user)
-        self.user = user
+        cls.user = user
 
     def test_simple_batch(self):
         """
@@ -59,82 +109,54 @@ class BatchRunTest(TestCase):
         It should not be processed (which was ok) but the dedrem should be deleted.
         """
         # Given
-        insuree = create_test_insuree()
-        self.assertIsNotNone(insuree)
-        service = create_test_service("A", custom_props={"name": "test_simple_batch"})
-        item = create_test_item("A", custom_props={"name": "test_simple_batch"})
-
-        product = create_test_product(
-            "BCUL0001",
-            custom_props={
-                "name": "simplebatch",
-                "lump_sum": 10_000,
-            },
-        )
-        payment_plan = create_test_payment_plan(
-            product=product,
-            calculation="0a1b6d54-eef4-4ee6-ac47-2a99cfa5e9a8",
-            custom_props={
-                'periodicity': 1,
-                'date_valid_from': '2019-01-01', 
-                'date_valid_to': '2050-01-01',
-                'json_ext': {
-                    'calculation_rule': {
-                        'hf_level_1': 'H',
-                        'hf_sublevel_1': "null",
-                        'hf_level_2': 'D',
-                        'hf_sublevel_2': "null",
-                        'hf_level_3': 'C',
-                        'hf_sublevel_3': "null",
-                        'hf_level_4': "null",
-                        'hf_sublevel_4': "null",
-                        'distr_1': 100,
-                        'distr_2': 100,
-                        'distr_3': 100,
-                        'distr_4': 100,
-                        'distr_5': 100,
-                        'distr_6': 100,
-                        'distr_7': 100,
-                        'distr_8': 100,
-                        'distr_9': 100,
-                        'distr_10': 100,
-                        'distr_11': 100,
-                        'distr_12': 100,
-                        'claim_type': 'B'
-                    }
-                }
-            }
-        )
+        # one savepoint for all the fixtures
+        with transaction.atomic():
+            insuree = create_test_insuree()
+            self.assertIsNotNone(insuree)
+            service = create_test_service("A", custom_props={"name": "test_simple_batch"})
+            item = create_test_item("A", custom_props={"name": "test_simple_batch"})
 
-        product_service = create_test_product_service(
-            product,
-            service,
-            custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
-        )
-        product_item = create_test_product_item(
-            product,
-            item,
-            custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
-        )
-        policy = create_test_policy(product, insuree, link=True)
-        payer = create_test_payer()
-        premium = create_test_premium(
-            policy_id=policy.id, custom_props={"payer_id": payer.id}
-        )
-        pricelist_detail1 = add_service_to_hf_pricelist(service)
-        pricelist_detail2 = add_item_to_hf_pricelist(item)
+            product = create_test_product(
+                "BCUL0001",
+                custom_props={
+                    "name": "simplebatch",
+                    "lump_sum": 10_000,
+                },
+            )
+            create_test_payment_plan(
+                product=product,
+                calculation="0a1b6d54-eef4-4ee6-ac47-2a99cfa5e9a8",
+                custom_props=_PAYMENT_PLAN_PROPS
+            )
+
+            create_test_product_service(
+                product,
+                service,
+                custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
+            )
+            create_test_product_item(
+                product,
+                item,
+                custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
+            )
+            policy = create_test_policy(product, insuree, link=True)
+            payer = create_test_payer()
+            create_test_premium(
+                policy_id=policy.id, custom_props={"payer_id": payer.id}
+            )
+            add_service_to_hf_pricelist(service)
+            add_item_to_hf_pricelist(item)
 
-        claim1 = create_test_claim({"insuree_id": insuree.id})
-        service1 = create_test_claimservice(
+        claim1 = create_test_claim({"insuree_id": insuree.id, "validity_from": _VALIDITY_FROM})
+        create_test_claimservice(
             claim1, custom_props={"service_id": service.id, "qty_provided": 2, "price_origin": ProductItemOrService.ORIGIN_RELATIVE}
         )
-        item1 = create_test_claimitem(
+        create_test_claimitem(
             claim1, "A", custom_props={"item_id": item.id, "qty_provided": 3, "price_origin": ProductItemOrService.ORIGIN_RELATIVE}
         )
         errors = validate_and_process_dedrem_claim(claim1, self.user, True)
-        _, days_in_month = calendar.monthrange(claim1.validity_from.year, claim1.validity_from.month)
         # add process stamp for claim to not use the process_stamp with now()
-        claim1.process_stamp = datetime.datetime(claim1.validity_from.year, claim1.validity_from.month, days_in_month-1)
+        claim1.process_stamp = _PROCESS_STAMP
         claim1.save()
 
         self.assertEqual(len(errors), 0)
@@ -144,39 +166,205 @@ class BatchRunTest(TestCase):
             "The claim has relative pricing, so should go to PROCESSED rather than VALUATED",
         )
         # Make sure that the dedrem was generated
-        dedrem = ClaimDedRem.objects.filter(claim=claim1).first()
+        dedrem = ClaimDedRem.objects.filter(claim_id=claim1.pk).values('rem_g').first()
         self.assertIsNotNone(dedrem)
-        self.assertEquals(dedrem.rem_g, 500)  # 100*2 + 100*3
+        self.assertEquals(dedrem['rem_g'], 500)  # 100*2 + 100*3
 
         # When
-        end_date = datetime.datetime(claim1.validity_from.year, claim1.validity_from.month, days_in_month)
-
         do_process_batch(
             self.user.id_for_audit,
             None,
-            end_date
+            _END_DATE
         )
 
-        claim1.refresh_from_db()
-        item1.refresh_from_db()
-        service1.refresh_from_db()
-
-        self.assertEquals(claim1.status, Claim.STATUS_VALUATED)
-
-        # tearDown
-        # dedrem.delete() # already done if the test passed
-        premium.delete()
-        payer.delete()
-        delete_claim_with_itemsvc_dedrem_and_history(claim1)
-        policy.insuree_policies.first().delete()
-        policy.delete()
-        product_item.delete()
-        product_service.delete()
-        pricelist_detail1.delete()
-        pricelist_detail2.delete()
-        service.delete()
-        item.delete()
-        product.relativeindex_set.all().delete()
-        product.relative_distributions.all().delete()
-        PaymentPlan.objects.filter(id=payment_plan.id).delete()
-        product.delete()
+        status = Claim.objects.filter(pk=claim1.pk).values_list('status', flat=True).first()
+
+        self.assertEquals(status, Claim.STATUS_VALUATED)
+
+
+class UpdateClaimValuatedTest(TestCase):
+    def test_claim_without_valuated_lines(self):
+        # rejected lines keep a NULL price_valuated, the claim must still be valuated to 0
+        insuree = create_test_insuree()
+        service = create_test_service("A", custom_props={"name": "test_claim_without_valuated_lines"})
+        item = create_test_item("A", custom_props={"name": "test_claim_without_valuated_lines"})
+        claim = create_test_claim({"insuree_id": insuree.id})
+        create_test_claimservice(claim, custom_props={"service_id": service.id, "price_valuated": None})
+        create_test_claimitem(claim, "A", custom_props={"item_id": item.id, "price_valuated": None})
+        batch_run = BatchRun.objects.create(run_year=2023, run_month=6, run_date=TimeUtils.now(),
+                                            audit_user_id=-1, validity_from=TimeUtils.now())
+
+        update_claim_valuated(Claim.objects.filter(id=claim.id), batch_run)
+
+        claim = Claim.objects.filter(id=claim.id).values('status', 'remunerated', 'batch_run_id').first()
+        self.assertEqual(claim['status'], Claim.STATUS_VALUATED)
+        self.assertEqual(claim['remunerated'], 0)
+        self.assertEqual(claim['batch_run_id'], batch_run.id)
+
+
+class BatchRunAlreadyExecutedTest(TestCase):
+    def setUp(self):
+        caches['default'].delete(_batch_run_cache_key(2023, 6, None))
+
+    def _create_batch_run(self):
+        return BatchRun.objects.create(run_year=2023, run_month=6, run_date=TimeUtils.now(),
+                                       audit_user_id=-1, validity_from=TimeUtils.now())
+
+    def test_missing_run_is_not_cached(self):
+        self.assertFalse(ProcessBatchService.batch_run_already_executed(2023, 6, None))
+        self._create_batch_run()
+        self.assertTrue(ProcessBatchService.batch_run_already_executed(2023, 6, None))
+
+    def test_existing_run_is_cached(self):
+        self._create_batch_run()
+        self.assertTrue(ProcessBatchService.batch_run_already_executed(2023, 6, None))
+        with self.assertNumQueries(0):
+            self.assertTrue(ProcessBatchService.batch_run_already_executed(2023, 6, None))
+
+
+class AllocatedPremiumTest(TestCase):
+    _START_DATE = datetime.date(2023, 6, 1)
+    _END_DATE = datetime.date(2023, 6, 30)
+
+    @staticmethod
+    def _python_allocated_premium(premiums, start_date, end_date):
+        # the per premium computation the aggregate replaced
+        allocated_premiums = 0
+        for premium in premiums:
+            allocation_start = max(premium.policy.effective_date, start_date)
+            allocation_stop = min(end_date, premium.policy.expiry_date)
+            allocation_diff = (allocation_stop - allocation_start).days + 1
+            policy_duration = (premium.policy.expiry_date - premium.policy.effective_date).days + 1
+            allocated_premiums += premium.amount * allocation_diff / policy_duration
+        return allocated_premiums
+
+    def test_allocated_premium(self):
+        insuree = create_test_insuree()
+        product = create_test_product("BCAL0001", custom_props={"name": "allocatedpremium"})
+        for effective_date, expiry_date, amount in [
+            (datetime.date(2023, 1, 1), datetime.date(2023, 12, 31), 365),  # covers the whole period: 30
+            (datetime.date(2023, 5, 1), datetime.date(2023, 6, 10), 410),  # ends inside the period: 100
+            (datetime.date(2023, 6, 5), datetime.date(2023, 6, 24), 100),  # inside the period: 100
+            (datetime.date(2023, 6, 21), datetime.date(2023, 7, 20), 90),  # starts inside the period: 30
+        ]:
+            policy = create_test_policy(product, insuree, link=True, custom_props={
+                "enroll_date": effective_date,
+                "start_date": effective_date,
+                "effective_date": effective_date,
+                "expiry_date": expiry_date,
+            })
+            create_test_premium(policy_id=policy.id, custom_props={"amount": amount})
+        premiums = get_contribution_queryset(product, self._START_DATE, self._END_DATE)
+
+        allocated_premium = get_allocated_premium(premiums, self._START_DATE, self._END_DATE)
+
+        self.assertIsInstance(allocated_premium, Decimal)
+        self.assertEqual(allocated_premium, self._python_allocated_premium(premiums, self._START_DATE, self._END_DATE))
+        self.assertEqual(allocated_premium, Decimal(260))
+
+    def test_no_premium(self):
+        product = create_test_product("BCAL0002", custom_props={"name": "nopremium"})
+        premiums = get_contribution_queryset(product, self._START_DATE, self._END_DATE)
+        self.assertEqual(get_allocated_premium(premiums, self._START_DATE, self._END_DATE), 0)
+
+
+class BatchInserterTest(TestCase):
+    def test_add_then_flush(self):
+        product = create_test_product("BCBI0001", custom_props={"name": "batchinserter"})
+        batch_inserter = BatchInserter()
+        for month in (5, 6):
+            batch_inserter.add(BatchRun(run_year=2023, run_month=month, run_date=TimeUtils.now(),
+                                        audit_user_id=-1, validity_from=TimeUtils.now()))
+        batch_inserter.add(RelativeDistribution(product=product, type=RelativeDistribution.TYPE_MONTH,
+                                                care_type=RelativeDistribution.CARE_TYPE_BOTH, period=6,
+                                                percent=100, validity_from=TimeUtils.now(), audit_user_id=-1))
+        self.assertFalse(BatchRun.objects.filter(run_year=2023).exists())
+
+        # one bulk insert per model
+        with self.assertNumQueries(2):
+            batch_inserter.flush()
+
+        self.assertEqual(BatchRun.objects.filter(run_year=2023).count(), 2)
+        self.assertEqual(RelativeDistribution.objects.filter(product=product).count(), 1)
+        self.assertEqual(len(batch_inserter.buffer), 0)
+        with self.assertNumQueries(0):
+            batch_inserter.flush()
+
+
+class GetStartDateTest(SimpleTestCase):
+    def test_yearly(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 12, 31), 12), datetime.date(2021, 1, 1))
+        self.assertIsNone(get_start_date(datetime.date(2021, 6, 30), 12))
+
+    def test_semester(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 6, 30), 6), datetime.date(2021, 1, 1))
+        self.assertEqual(get_start_date(datetime.date(2021, 12, 31), 6), datetime.date(2021, 7, 1))
+        self.assertIsNone(get_start_date(datetime.date(2021, 5, 31), 6))
+
+    def test_four_months(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 4, 30), 4), datetime.date(2021, 1, 1))
+        self.assertEqual(get_start_date(datetime.date(2021, 8, 31), 4), datetime.date(2021, 5, 1))
+        self.assertEqual(get_start_date(datetime.date(2021, 12, 31), 4), datetime.date(2021, 9, 1))
+        self.assertIsNone(get_start_date(datetime.date(2021, 6, 30), 4))
+
+    def test_quarter(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 9, 30), 3), datetime.date(2021, 7, 1))
+        self.assertIsNone(get_start_date(datetime.date(2021, 8, 31), 3))
+
+    def test_bimonthly(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 2, 28), 2), datetime.date(2021, 1, 1))
+        self.assertIsNone(get_start_date(datetime.date(2021, 3, 31), 2))
+
+    def test_monthly(self):
+        self.assertEqual(get_start_date(datetime.date(2021, 3, 31), 1), datetime.date(2021, 3, 1))
+
+    def test_unknown_periodicity(self):
+        self.assertIsNone(get_start_date(datetime.date(2021, 12, 31), 5))
+        self.assertIsNone(get_start_date(datetime.date(2021, 12, 31), None))
+
+
+class ReportSumsTest(SimpleTestCase):
+    # the small reports are summed in pure python, the large ones with pandas: both must agree
+    def _rows(self):
+        rows = []
+        for i, (region, district, hf_code, product_code) in enumerate([
+            ("R1", "D1", "HF1", "P1"), ("R1", "D1", "HF2", "P1"), ("R1", "D2", "HF3", "P2"),
+            ("R2", "D3", "HF4", "P1"), ("R1", "D1", "HF1", "P2"), ("R2", "D3", "HF4", "P1"),
+        ]):
+            rows.append({
+                "RegionName": region,
+                "DistrictName": district,
+                "HFID": None if i == 1 else i,
+                "HFCode": hf_code,
+                "HFName": None if i % 2 else "HF %s" % hf_code,
+                "ProductCode": product_code,
+                "ProductName": "Product %s" % product_code,
+                "PriceAsked": Decimal("10.50") * i,
+                "PriceApproved": None if i % 3 == 0 else Decimal("7.25"),
+                "PriceAdjusted": None,
+                "RemuneratedAmount": None if i == 2 else Decimal(i) / 4,
+            })
+        return rows
+
+    def _assert_same_sums(self, leaf_column, leaf_prefix, add_sums_by, show_claims):
+        data = self._rows()
+        small = _small_report_aggregate(data, leaf_column, leaf_prefix, show_claims)
+        large = add_sums_by(report_data_frame(data), show_claims)
+        self.assertEqual(small, large)
+        # 2 == 2.0, the values must also keep their type (no int turned to float by pandas)
+        self.assertEqual(
+            [{key: type(value) for key, value in row.items()} for row in small],
+            [{key: type(value) for key, value in row.items()} for row in large],
+        )
+
+    def test_by_hf(self):
+        self._assert_same_sums('HFCode', 'SUMHF_', add_sums_by_hf, False)
+
+    def test_by_hf_with_claims(self):
+        self._assert_same_sums('HFCode', 'SUMHF_', add_sums_by_hf, True)
+
+    def test_by_product(self):
+        self._assert_same_sums('ProductCode', 'SUMP_', add_sums_by_prod, False)
+
+    def test_by_product_with_claims(self):
+        self._assert_same_sums('ProductCode', 'SUMP_', add_sums_by_prod, True)
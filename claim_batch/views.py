@@ -6,19 +6,23 @@ from .apps import ClaimBatchConfig
 from django.utils.translation import gettext as _
 
 
+_REPORTS = {
+    (True, 'H'): ("claim_batch_pbc_H", pbc_H.template),
+    (True, 'P'): ("claim_batch_pbc_P", pbc_P.template),
+    (False, 'H'): ("claim_batch_pbh", pbh.template),
+    (False, 'P'): ("claim_batch_pbp", pbp.template),
+}
+
+
 def _report(prms):
     show_claims = prms.get("showClaims", "false") == 'true'
     group = prms.get("group", "H")
-    if show_claims:
-        report = "claim_batch_pbc_"+group
-        default = pbc_H.template if group == 'H' else pbc_P.template
-    elif group == 'H':
-        report = "claim_batch_pbh"
-        default = pbh.template
+    if (show_claims, group) in _REPORTS:
+        return _REPORTS[(show_claims, group)]
+    elif show_claims:
+        return "claim_batch_pbc_" + group, pbc_P.template
     else:
-        report = "claim_batch_pbp"
-        default = pbp.template
-    return report, default
+        return _REPORTS[(False, 'P')]
 
 
 def report(request):